@@ -114,9 +114,23 @@ def get_dev_bpf():
     raise Scapy_Exception("No /dev/bpf handle is available !")
 
 
+# Compiled BPF programs, by filter and interface. libpcap never frees them,
+# so that they stay valid while cached.
+_COMPILED_FILTERS = {}
+_COMPILED_FILTERS_MAX = 64
+
+
 def attach_filter(fd, bpf_filter, iface):
     """Attach a BPF filter to the BPF file descriptor"""
-    bp = compile_filter(bpf_filter, iface)
+    key = (bpf_filter, iface)
+    bp = _COMPILED_FILTERS.get(key)
+    if bp is None:
+        # Guessing the link type runs ifconfig, and libpcap compiles the
+        # filter: only do it once per filter and interface
+        bp = compile_filter(bpf_filter, iface)
+        if len(_COMPILED_FILTERS) >= _COMPILED_FILTERS_MAX:
+            _COMPILED_FILTERS.clear()
+        _COMPILED_FILTERS[key] = bp
     # Assign the BPF program to the interface
     ret = LIBC.ioctl(c_int(fd), BIOCSETF, cast(pointer(bp), c_char_p))
     if ret < 0:
@@ -4,6 +4,7 @@
 Scapy *BSD native support - BPF sockets
 """
 
+from collections import deque
 from ctypes import c_long, sizeof
 import errno
 import fcntl
@@ -11,8 +12,15 @@ import os
 import platform
 from select import select
 import struct
+import threading
 import time
 
+try:
+    from select import kqueue, kevent, KQ_FILTER_READ, KQ_EV_ADD, \
+        KQ_EV_ERROR
+except ImportError:
+    kqueue = None
+
 from scapy.arch.bpf.core import get_dev_bpf, attach_filter
 from scapy.arch.bpf.consts import BIOCGBLEN, BIOCGDLT, BIOCGSTATS, \
     BIOCIMMEDIATE, BIOCPROMISC, BIOCSBLEN, BIOCSETIF, BIOCSHDRCMPLT, \
@@ -23,6 +31,7 @@ from scapy.data import ETH_P_ALL
 from scapy.error import Scapy_Exception, warning
 from scapy.supersocket import SuperSocket
 from scapy.compat import raw
+from scapy.modules.six.moves import intern
 
 
 if FREEBSD:
@@ -33,6 +42,49 @@ elif NETBSD:
 else:
     BPF_ALIGNMENT = 4  # sizeof(int32_t)
 
+# Offset of bh_caplen in struct bpf_hdr
+if FREEBSD:
+    # Unless we set BIOCSTSTAMP to something different than
+    # BPF_T_MICROTIME, we will get bpf_hdr on FreeBSD, which means
+    # that we'll get a struct timeval, which is time_t, suseconds_t.
+    # On i386 time_t is 32bit so the bh_tstamp will only be 8 bytes.
+    # We really want to set BIOCSTSTAMP to BPF_T_NANOTIME and be
+    # done with this and it always be 16?
+    if platform.machine() == "i386":
+        # struct bpf_hdr
+        BH_TSTAMP_OFFSET = 8
+    else:
+        # struct bpf_hdr (64bit time_t) or struct bpf_xhdr
+        BH_TSTAMP_OFFSET = 16
+elif NETBSD:
+    # struct bpf_hdr or struct bpf_hdr32
+    BH_TSTAMP_OFFSET = 16
+else:
+    # struct bpf_hdr
+    BH_TSTAMP_OFFSET = 8
+
+# ioctl() arguments
+_u_int = struct.Struct("I")
+_int = struct.Struct("i")
+_bpf_stat = struct.Struct("2I")
+_ifreq_name = struct.Struct("16s16x")
+_ifreq_cache = {}
+
+# bh_caplen, bh_datalen and bh_hdrlen from struct bpf_hdr
+_bpf_hdr_fields = struct.Struct("IIH")
+
+# kqueue used by bpf_select(), and the file descriptors registered in it
+_kqueue_cache = threading.local()
+
+
+def get_ifreq(iface):
+    """Return the struct ifreq used to assign iface to a BPF handle"""
+
+    ifreq = _ifreq_cache.get(iface)
+    if ifreq is None:
+        ifreq = _ifreq_cache[iface] = _ifreq_name.pack(iface.encode())
+    return ifreq
+
 
 # SuperSockets definitions
 
@@ -64,17 +116,17 @@ class _L2bpfSocket(SuperSocket):
 
         # Set the BPF buffer length
         try:
-            fcntl.ioctl(self.ins, BIOCSBLEN, struct.pack('I', BPF_BUFFER_LENGTH))  # noqa: E501
+            fcntl.ioctl(self.ins, BIOCSBLEN, _u_int.pack(BPF_BUFFER_LENGTH))
         except IOError:
             raise Scapy_Exception("BIOCSBLEN failed on /dev/bpf%i" %
                                   self.dev_bpf)
 
         # Assign the network interface to the BPF handle
         try:
-            fcntl.ioctl(self.ins, BIOCSETIF, struct.pack("16s16x", self.iface.encode()))  # noqa: E501
+            fcntl.ioctl(self.ins, BIOCSETIF, get_ifreq(self.iface))
         except IOError:
             raise Scapy_Exception("BIOCSETIF failed on %s" % self.iface)
-        self.assigned_interface = self.iface
+        self.assigned_interface = intern(self.iface)
 
         # Set the interface into promiscuous
         if self.promisc:
@@ -84,7 +136,7 @@ class _L2bpfSocket(SuperSocket):
         # Note: - trick from libpcap/pcap-bpf.c - monitor_mode()
         #       - it only works on OS X 10.5 and later
         if DARWIN and monitor:
-            dlt_radiotap = struct.pack('I', DLT_IEEE802_11_RADIO)
+            dlt_radiotap = _u_int.pack(DLT_IEEE802_11_RADIO)
             try:
                 fcntl.ioctl(self.ins, BIOCSDLT, dlt_radiotap)
             except IOError:
@@ -93,15 +145,20 @@ class _L2bpfSocket(SuperSocket):
 
         # Don't block on read
         try:
-            fcntl.ioctl(self.ins, BIOCIMMEDIATE, struct.pack('I', 1))
+            fcntl.ioctl(self.ins, BIOCIMMEDIATE, _u_int.pack(1))
         except IOError:
             raise Scapy_Exception("BIOCIMMEDIATE failed on /dev/bpf%i" %
                                   self.dev_bpf)
 
+        # The file descriptor stays non blocking: blocking reads wait for
+        # frames with select() when they get EAGAIN
+        self.set_nonblock(True)
+        self.blocking_read = True
+
         # Scapy will provide the link layer source address
         # Otherwise, it is written by the kernel
         try:
-            fcntl.ioctl(self.ins, BIOCSHDRCMPLT, struct.pack('i', 1))
+            fcntl.ioctl(self.ins, BIOCSHDRCMPLT, _int.pack(1))
         except IOError:
             raise Scapy_Exception("BIOCSHDRCMPLT failed on /dev/bpf%i" %
                                   self.dev_bpf)
@@ -126,7 +183,7 @@ class _L2bpfSocket(SuperSocket):
         """Set the interface in promiscuous mode"""
 
         try:
-            fcntl.ioctl(self.ins, BIOCPROMISC, struct.pack('i', value))
+            fcntl.ioctl(self.ins, BIOCPROMISC, _int.pack(value))
         except IOError:
             raise Scapy_Exception("Cannot set promiscuous mode on interface "
                                   "(%s)!" % self.iface)
@@ -143,8 +200,8 @@ class _L2bpfSocket(SuperSocket):
 
         # Get the data link type
         try:
-            ret = fcntl.ioctl(self.ins, BIOCGDLT, struct.pack('I', 0))
-            ret = struct.unpack('I', ret)[0]
+            ret = fcntl.ioctl(self.ins, BIOCGDLT, _u_int.pack(0))
+            ret = _u_int.unpack(ret)[0]
         except IOError:
             cls = conf.default_l2
             warning("BIOCGDLT failed: unable to guess type. Using %s !",
@@ -157,6 +214,7 @@ class _L2bpfSocket(SuperSocket):
         except KeyError:
             cls = conf.default_l2
             warning("Unable to guess type (type %i). Using %s", ret, cls.name)
+            return cls
 
     def set_nonblock(self, set_flag=True):
         """Set the non blocking flag on the socket"""
@@ -185,8 +243,8 @@ class _L2bpfSocket(SuperSocket):
         """Get received / dropped statistics"""
 
         try:
-            ret = fcntl.ioctl(self.ins, BIOCGSTATS, struct.pack("2I", 0, 0))
-            return struct.unpack("2I", ret)
+            ret = fcntl.ioctl(self.ins, BIOCGSTATS, _bpf_stat.pack(0, 0))
+            return _bpf_stat.unpack(ret)
         except IOError:
             warning("Unable to get stats from BPF !")
             return (None, None)
@@ -195,8 +253,8 @@ class _L2bpfSocket(SuperSocket):
         """Get the BPF buffer length"""
 
         try:
-            ret = fcntl.ioctl(self.ins, BIOCGBLEN, struct.pack("I", 0))
-            return struct.unpack("I", ret)[0]
+            ret = fcntl.ioctl(self.ins, BIOCGBLEN, _u_int.pack(0))
+            return _u_int.unpack(ret)[0]
         except IOError:
             warning("Unable to get the BPF buffer length")
             return
@@ -238,7 +296,12 @@ class L2bpfListenSocket(_L2bpfSocket):
     """"Scapy L2 BPF Listen Super Socket"""
 
     def __init__(self, *args, **kwargs):
-        self.received_frames = []
+        self.received_frames = deque()
+        # Reused by recv_raw(), as frames are copied out of it
+        if hasattr(os, "readv"):
+            self.read_buffer = memoryview(bytearray(BPF_BUFFER_LENGTH))
+        else:
+            self.read_buffer = None
         super(L2bpfListenSocket, self).__init__(*args, **kwargs)
 
     def buffered_frames(self):
@@ -248,7 +311,7 @@ class L2bpfListenSocket(_L2bpfSocket):
     def get_frame(self):
         """Get a frame or packet from the received list"""
         if self.received_frames:
-            return self.received_frames.pop(0)
+            return self.received_frames.popleft()
         else:
             return None, None, None
 
@@ -262,51 +325,33 @@ class L2bpfListenSocket(_L2bpfSocket):
     def extract_frames(self, bpf_buffer):
         """Extract all frames from the buffer and stored them in the received list."""  # noqa: E501
 
+        bpf_view = memoryview(bpf_buffer)
+        len_bb = len(bpf_view)
+        offset = 0
+
+        # Resolve what the loop needs once per buffer, not once per frame
+        unpack_bpf_hdr = _bpf_hdr_fields.unpack_from
+        append_frame = self.received_frames.append
+        guessed_cls = self.guessed_cls
+        align_mask = ~(BPF_ALIGNMENT - 1)
+
         # Ensure that the BPF buffer contains at least the header
-        len_bb = len(bpf_buffer)
-        if len_bb < 20:  # Note: 20 == sizeof(struct bfp_hdr)
-            return
+        while len_bb - offset >= 20:  # Note: 20 == sizeof(struct bfp_hdr)
 
-        # Extract useful information from the BPF header
-        if FREEBSD:
-            # Unless we set BIOCSTSTAMP to something different than
-            # BPF_T_MICROTIME, we will get bpf_hdr on FreeBSD, which means
-            # that we'll get a struct timeval, which is time_t, suseconds_t.
-            # On i386 time_t is 32bit so the bh_tstamp will only be 8 bytes.
-            # We really want to set BIOCSTSTAMP to BPF_T_NANOTIME and be
-            # done with this and it always be 16?
-            if platform.machine() == "i386":
-                # struct bpf_hdr
-                bh_tstamp_offset = 8
-            else:
-                # struct bpf_hdr (64bit time_t) or struct bpf_xhdr
-                bh_tstamp_offset = 16
-        elif NETBSD:
-            # struct bpf_hdr or struct bpf_hdr32
-            bh_tstamp_offset = 16
-        else:
-            # struct bpf_hdr
-            bh_tstamp_offset = 8
-
-        # Parse the BPF header
-        bh_caplen = struct.unpack('I', bpf_buffer[bh_tstamp_offset:bh_tstamp_offset + 4])[0]  # noqa: E501
-        next_offset = bh_tstamp_offset + 4
-        bh_datalen = struct.unpack('I', bpf_buffer[next_offset:next_offset + 4])[0]  # noqa: E501
-        next_offset += 4
-        bh_hdrlen = struct.unpack('H', bpf_buffer[next_offset:next_offset + 2])[0]  # noqa: E501
-        if bh_datalen == 0:
-            return
+            # Parse the BPF header
+            bh_caplen, bh_datalen, bh_hdrlen = unpack_bpf_hdr(
+                bpf_view, offset + BH_TSTAMP_OFFSET
+            )
+            if bh_datalen == 0:
+                return
 
-        # Get and store the Scapy object
-        frame_str = bpf_buffer[bh_hdrlen:bh_hdrlen + bh_caplen]
-        self.received_frames.append(
-            (self.guessed_cls, frame_str, None)
-        )
+            # Get and store the Scapy object
+            start = offset + bh_hdrlen
+            frame_str = bpf_view[start:start + bh_caplen].tobytes()
+            append_frame((guessed_cls, frame_str, None))
 
-        # Extract the next frame
-        end = self.bpf_align(bh_hdrlen, bh_caplen)
-        if (len_bb - end) >= 20:
-            self.extract_frames(bpf_buffer[end:])
+            # Move to the next frame, see bpf_align()
+            offset += (bh_hdrlen + bh_caplen + BPF_ALIGNMENT - 1) & align_mask
 
     def recv_raw(self, x=BPF_BUFFER_LENGTH):
         """Receive a frame from the network"""
@@ -318,12 +363,21 @@ class L2bpfListenSocket(_L2bpfSocket):
             return self.get_frame()
 
         # Get data from BPF
-        try:
-            bpf_buffer = os.read(self.ins, x)
-        except EnvironmentError as exc:
-            if exc.errno != errno.EAGAIN:
-                warning("BPF recv_raw()", exc_info=True)
-            return None, None, None
+        while True:
+            try:
+                if self.read_buffer is None:
+                    bpf_buffer = os.read(self.ins, x)
+                else:
+                    length = os.readv(self.ins, [self.read_buffer[:x]])
+                    bpf_buffer = self.read_buffer[:length]
+                break
+            except EnvironmentError as exc:
+                if exc.errno != errno.EAGAIN:
+                    warning("BPF recv_raw()", exc_info=True)
+                    return None, None, None
+                if not self.blocking_read:
+                    return None, None, None
+            select([self.ins], [], [])
 
         # Extract all frames from the BPF buffer
         self.extract_frames(bpf_buffer)
@@ -344,15 +398,33 @@ class L2bpfSocket(L2bpfListenSocket):
             # Get a frame from the buffer
             return L2bpfListenSocket.recv(self)
 
-        # Set the non blocking flag, read from the socket, and unset the flag
-        self.set_nonblock(True)
-        pkt = L2bpfListenSocket.recv(self)
-        self.set_nonblock(False)
-        return pkt
+        # The file descriptor is already non blocking, only recv_raw() must
+        # not wait for frames
+        self.blocking_read = False
+        try:
+            return L2bpfListenSocket.recv(self)
+        finally:
+            self.blocking_read = True
 
 
 class L3bpfSocket(L2bpfSocket):
 
+    def __init__(self, *args, **kwargs):
+        super(L3bpfSocket, self).__init__(*args, **kwargs)
+        self.reset_header_cache()
+
+    def reset_header_cache(self):
+        """Cache the link layer headers if they do not depend on the packet
+        contents"""
+
+        from scapy.layers.l2 import Loopback
+        # A loopback header only depends on the payload class, while an
+        # Ethernet one depends on the destination
+        if self.guessed_cls is Loopback:
+            self.header_cache = {}
+        else:
+            self.header_cache = None
+
     def recv(self, x=BPF_BUFFER_LENGTH):
         """Receive on layer 3"""
         r = SuperSocket.recv(self, x)
@@ -368,17 +440,31 @@ class L3bpfSocket(L2bpfSocket):
         iff = pkt.route()[0]
         if iff is None:
             iff = conf.iface
+        # assigned_interface is interned too, so that the same interface
+        # is detected with an identity check
+        iff = intern(iff)
 
         # Assign the network interface to the BPF handle
-        if self.assigned_interface != iff:
+        if self.assigned_interface is not iff:
             try:
-                fcntl.ioctl(self.outs, BIOCSETIF, struct.pack("16s16x", iff.encode()))  # noqa: E501
+                fcntl.ioctl(self.outs, BIOCSETIF, get_ifreq(iff))
             except IOError:
                 raise Scapy_Exception("BIOCSETIF failed on %s" % iff)
             self.assigned_interface = iff
+            self.guessed_cls = self.guess_cls()
+            self.reset_header_cache()
 
         # Build the frame
-        frame = raw(self.guessed_cls() / pkt)
+        if self.header_cache is None:
+            frame = raw(self.guessed_cls() / pkt)
+        else:
+            payload = raw(pkt)
+            header = self.header_cache.get(pkt.__class__)
+            if header is None:
+                frame = raw(self.guessed_cls() / pkt)
+                header = frame[:len(frame) - len(payload)]
+                self.header_cache[pkt.__class__] = header
+            frame = header + payload
         pkt.sent_time = time.time()
 
         # Send the frame
@@ -387,13 +473,42 @@ class L3bpfSocket(L2bpfSocket):
 
 # Sockets manipulation functions
 
+# L2bpfSocket and L3bpfSocket inherit from L2bpfListenSocket
+_BPF_SOCK_TYPES = (L2bpfListenSocket,)
+
+
 def isBPFSocket(obj):
     """Return True is obj is a BPF Super Socket"""
-    return isinstance(
-        obj,
-        (L2bpfListenSocket, L2bpfListenSocket, L3bpfSocket)
+    return isinstance(obj, _BPF_SOCK_TYPES)
+
+
+def kqueue_select(fds_list, timeout):
+    """Return the readable objects from fds_list, using a kqueue.
+
+    The kqueue is kept per thread, and only recreated when the set of
+    file descriptors to watch changes.
+    """
+
+    fds_map = dict(
+        (tmp_fd if isinstance(tmp_fd, int) else tmp_fd.fileno(), tmp_fd)
+        for tmp_fd in fds_list
     )
 
+    kq = getattr(_kqueue_cache, "kq", None)
+    if kq is None or _kqueue_cache.fds != set(fds_map):
+        if kq is not None:
+            kq.close()
+        kq = _kqueue_cache.kq = kqueue()
+        _kqueue_cache.fds = set(fds_map)
+
+    # Registering again is a no-op, but it is done in the same system call
+    # and covers descriptors that were closed and reused in the meantime
+    changes = [kevent(fd, filter=KQ_FILTER_READ, flags=KQ_EV_ADD)
+               for fd in fds_map]
+    events = kq.control(changes, len(changes), timeout)
+    return [fds_map[event.ident] for event in events
+            if not event.flags & KQ_EV_ERROR]
+
 
 def bpf_select(fds_list, timeout=None):
     """A call to recv() can return several frames. This functions hides the fact
@@ -417,7 +532,10 @@ def bpf_select(fds_list, timeout=None):
         # Call select for sockets with empty buffers
         if timeout is None:
             timeout = 0.05
-        ready_list, _, _ = select(select_fds, [], [], timeout)
+        if kqueue is None:
+            ready_list, _, _ = select(select_fds, [], [], timeout)
+        else:
+            ready_list = kqueue_select(select_fds, timeout)
         return bpf_scks_buffered + ready_list
     else:
         return bpf_scks_buffered
@@ -79,4 +79,5 @@ class AltBeacon(Packet, LowEnergyBeaconHelper):
         ]
 
 
-EIR_Manufacturer_Specific_Data.register_magic_payload(AltBeacon)
+EIR_Manufacturer_Specific_Data.register_magic_payload(
+    AltBeacon, magic_prefix=AltBeacon.magic)
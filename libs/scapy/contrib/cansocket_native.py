@@ -10,6 +10,11 @@
 NativeCANSocket.
 """
 
+import ctypes
+from ctypes.util import find_library
+import errno
+import os
+from select import select
 import struct
 import socket
 import time
@@ -25,6 +30,124 @@ conf.contribs['NativeCANSocket'] = {'channel': "can0"}
 CAN_FRAME_SIZE = 16
 CAN_INV_FILTER = 0x20000000
 
+# CAN ID/flags field, in network and in SocketCAN byte order
+_can_id_be = struct.Struct(">I")
+_can_id_le = struct.Struct("<I")
+# struct can_frame: can_id, len, reserved bytes and data
+_can_frame = struct.Struct("=IB3s8s")
+_can_frame_le = struct.Struct("<IB3s8s")
+
+# recvmmsg() and sendmmsg() are not exposed by the socket module
+try:
+    LIBC = ctypes.CDLL(find_library("c"), use_errno=True)
+    _recvmmsg = LIBC.recvmmsg
+    _sendmmsg = LIBC.sendmmsg
+except (OSError, AttributeError):
+    _recvmmsg = _sendmmsg = None
+
+SO_TIMESTAMP = 29
+SCM_TIMESTAMP = SO_TIMESTAMP
+MSG_WAITFORONE = 0x10000
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p),
+                ("iov_len", ctypes.c_size_t)]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p),
+                ("msg_namelen", ctypes.c_uint32),
+                ("msg_iov", ctypes.c_void_p),
+                ("msg_iovlen", ctypes.c_size_t),
+                ("msg_control", ctypes.c_void_p),
+                ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr),
+                ("msg_len", ctypes.c_uint)]
+
+
+class _cmsg_timeval(ctypes.Structure):
+    """struct cmsghdr followed by the struct timeval of SCM_TIMESTAMP"""
+    _fields_ = [("cmsg_len", ctypes.c_size_t),
+                ("cmsg_level", ctypes.c_int),
+                ("cmsg_type", ctypes.c_int),
+                ("tv_sec", ctypes.c_long),
+                ("tv_usec", ctypes.c_long)]
+
+
+if _recvmmsg is not None:
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                          ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint,
+                          ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+
+class _MMsgVector(object):
+    """Preallocated messages and buffers for count CAN frames, as used by
+    recvmmsg() and sendmmsg()."""
+
+    def __init__(self, count):
+        self.count = count
+        self.frames = ctypes.create_string_buffer(count * CAN_FRAME_SIZE)
+        self.iovecs = (_iovec * count)()
+        self.controls = (_cmsg_timeval * count)()
+        self.msgs = (_mmsghdr * count)()
+        frames_addr = ctypes.addressof(self.frames)
+        iovecs_addr = ctypes.addressof(self.iovecs)
+        for i in range(count):
+            self.iovecs[i].iov_base = frames_addr + i * CAN_FRAME_SIZE
+            self.iovecs[i].iov_len = CAN_FRAME_SIZE
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_iov = iovecs_addr + i * ctypes.sizeof(_iovec)
+            hdr.msg_iovlen = 1
+
+    def address(self, index=0):
+        """Return the address of the index-th message"""
+        return ctypes.addressof(self.msgs) + index * ctypes.sizeof(_mmsghdr)
+
+    def prepare_recv(self):
+        """Reset the ancillary data buffers, updated by the kernel"""
+        controls_addr = ctypes.addressof(self.controls)
+        for i in range(self.count):
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_control = controls_addr + i * ctypes.sizeof(_cmsg_timeval)
+            hdr.msg_controllen = ctypes.sizeof(_cmsg_timeval)
+            self.iovecs[i].iov_len = CAN_FRAME_SIZE
+
+    def prepare_send(self, frames):
+        """Copy frames to the buffers, without ancillary data"""
+        frames_addr = ctypes.addressof(self.frames)
+        for i, frame in enumerate(frames):
+            ctypes.memmove(frames_addr + i * CAN_FRAME_SIZE, frame,
+                           len(frame))
+            self.iovecs[i].iov_len = len(frame)
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_control = None
+            hdr.msg_controllen = 0
+
+    def frame(self, index):
+        """Return the bytes received in the index-th message"""
+        return ctypes.string_at(
+            ctypes.addressof(self.frames) + index * CAN_FRAME_SIZE,
+            self.msgs[index].msg_len
+        )
+
+    def timestamp(self, index):
+        """Return the SCM_TIMESTAMP of the index-th message, if any"""
+        hdr = self.msgs[index].msg_hdr
+        cmsg = self.controls[index]
+        if hdr.msg_controllen >= ctypes.sizeof(_cmsg_timeval) and \
+                cmsg.cmsg_level == socket.SOL_SOCKET and \
+                cmsg.cmsg_type == SCM_TIMESTAMP:
+            return cmsg.tv_sec + cmsg.tv_usec / 1000000.0
+        return time.time()
+
 
 class NativeCANSocket(SuperSocket):
     desc = "read/write packets at a given CAN interface using PF_CAN sockets"
@@ -41,6 +164,10 @@ class NativeCANSocket(SuperSocket):
 
         self.basecls = basecls
         self.remove_padding = remove_padding
+        # The CAN ID/flags field of SocketCAN frames is in host byte order,
+        # and has to be swapped unless the CAN layer already does it.
+        # Changing conf.contribs['CAN']['swap-bytes'] requires a new socket.
+        self.swap_id = not conf.contribs['CAN']['swap-bytes']
         self.channel = conf.contribs['NativeCANSocket']['channel'] if \
             channel is None else channel
         self.ins = socket.socket(socket.PF_CAN,
@@ -73,6 +200,11 @@ class NativeCANSocket(SuperSocket):
 
         self.ins.bind((self.channel,))
         self.outs = self.ins
+        # recv_batch() and send_batch() may run in different threads: they
+        # do not share their buffers
+        self.mmsg_vector = None
+        self.send_vector = None
+        self.mmsg_timestamps = False
 
     def recv(self, x=CAN_FRAME_SIZE):
         try:
@@ -88,34 +220,175 @@ class NativeCANSocket(SuperSocket):
             warning("Captured no data.")
             return None
 
+        return self._decode_frame(pkt, get_last_packet_timestamp(self.ins))
+
+    def _decode_frame(self, pkt, timestamp):
         # need to change the byte order of the first four bytes,
         # required by the underlying Linux SocketCAN frame format
-        if not conf.contribs['CAN']['swap-bytes']:
-            pkt = struct.pack("<I12s", *struct.unpack(">I12s", pkt))
+        if self.swap_id:
+            pkt = _can_id_le.pack(*_can_id_be.unpack_from(pkt)) + pkt[4:]
 
         len = pkt[4]
         canpkt = self.basecls(pkt[:len + 8])
-        canpkt.time = get_last_packet_timestamp(self.ins)
+        canpkt.time = timestamp
         if self.remove_padding:
             return canpkt
         else:
             return canpkt / Padding(pkt[len + 8:])
 
+    @staticmethod
+    def decode_frames(buf):
+        """Decode consecutive SocketCAN frames, e.g. from a raw dump.
+
+        All the frames are unpacked by a single struct.iter_unpack() pass,
+        and the CAN packets are built from the values, which is cheaper
+        than dissecting each frame. Padding is removed.
+
+        :param buf: bytes-like object, a multiple of CAN_FRAME_SIZE long
+        :return: list of CAN packets
+        """
+        if len(buf) % CAN_FRAME_SIZE:
+            raise Scapy_Exception("The buffer length is not a multiple of "
+                                  "%d" % CAN_FRAME_SIZE)
+        return [CAN(flags=can_id >> 29, identifier=can_id & 0x1fffffff,
+                    length=length,
+                    reserved=int.from_bytes(reserved, "big"),
+                    data=data[:length])
+                for can_id, length, reserved, data in
+                _can_frame.iter_unpack(buf)]
+
+    def recv_batch(self, count=64):
+        """Receive up to count frames with a single recvmmsg() call.
+
+        Waits for the first frame only, at most for the socket timeout, and
+        returns the frames that are already queued after it. Falls back to
+        recv() when recvmmsg() is not available.
+
+        :param count: maximum number of frames to return
+        :return: list of received packets
+        """
+        if _recvmmsg is None:
+            pkt = self.recv()
+            return [] if pkt is None else [pkt]
+
+        if not self.mmsg_timestamps:
+            # SIOCGSTAMP only reports the last frame of a batch
+            self.ins.setsockopt(socket.SOL_SOCKET, SO_TIMESTAMP, 1)
+            self.mmsg_timestamps = True
+        if self.mmsg_vector is None or self.mmsg_vector.count < count:
+            self.mmsg_vector = _MMsgVector(count)
+        vector = self.mmsg_vector
+
+        # settimeout() makes the socket non-blocking: recvmmsg() would
+        # return at once instead of waiting for the timeout
+        timeout = self.ins.gettimeout()
+        if timeout:
+            ready, _, _ = select([self.ins], [], [], timeout)
+            if not ready:
+                warning("Captured no data, socket read timed out.")
+                return []
+
+        vector.prepare_recv()
+        ret = _recvmmsg(self.ins.fileno(), vector.address(), count,
+                        MSG_WAITFORONE, None)
+        if ret < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                warning("Captured no data, socket in non-blocking mode.")
+            else:
+                # something bad happened (e.g. the interface went down)
+                warning("Captured no data (%s).", os.strerror(err))
+            return []
+
+        return [self._decode_frame(vector.frame(i), vector.timestamp(i))
+                for i in range(ret)]
+
+    @staticmethod
+    def _pack_can(x):
+        """Pack a plain CAN packet straight into a SocketCAN frame.
+
+        :return: the frame, or None if it has to be built by Scapy
+        """
+        flags = int(x.getfieldval("flags"))
+        identifier = x.getfieldval("identifier")
+        length = x.getfieldval("length")
+        reserved = x.getfieldval("reserved")
+        data = x.getfieldval("data")
+        if not isinstance(data, bytes) or len(data) > 8:
+            return None
+        if length is None:
+            length = len(data)
+        if not all(isinstance(val, int)
+                   for val in (flags, identifier, length, reserved)):
+            return None
+        return _can_frame_le.pack(((flags & 0x7) << 29) |
+                                  (identifier & 0x1FFFFFFF),
+                                  length & 0xFF,
+                                  (reserved & 0xFFFFFF).to_bytes(3, "big"),
+                                  data)
+
+    def _encode_frame(self, x):
+        if hasattr(x, "sent_time"):
+            x.sent_time = time.time()
+
+        # Both byte orders end up with a little endian CAN id: plain CAN
+        # packets skip the build and the byte swap
+        if type(x) is CAN and not x.payload:
+            bs = self._pack_can(x)
+            if bs is not None:
+                return bs
+
+        # need to change the byte order of the first four bytes,
+        # required by the underlying Linux SocketCAN frame format
+        bs = bytes(x)
+        if self.swap_id:
+            bs = bs + b'\x00' * (CAN_FRAME_SIZE - len(bs))
+            bs = _can_id_le.pack(*_can_id_be.unpack_from(bs)) + bs[4:]
+        return bs
+
     def send(self, x):
         try:
-            if hasattr(x, "sent_time"):
-                x.sent_time = time.time()
-
-            # need to change the byte order of the first four bytes,
-            # required by the underlying Linux SocketCAN frame format
-            bs = bytes(x)
-            if not conf.contribs['CAN']['swap-bytes']:
-                bs = bs + b'\x00' * (CAN_FRAME_SIZE - len(bs))
-                bs = struct.pack("<I12s", *struct.unpack(">I12s", bs))
-            return SuperSocket.send(self, bs)
+            return SuperSocket.send(self, self._encode_frame(x))
         except socket.error as msg:
             raise msg
 
+    def send_batch(self, pkts):
+        """Send packets with as few sendmmsg() calls as possible.
+
+        Falls back to send() when sendmmsg() is not available. Nothing is
+        sent if a packet builds to more than CAN_FRAME_SIZE bytes.
+
+        :param pkts: list of packets to send
+        :return: number of sent packets
+        """
+        if _sendmmsg is None:
+            for pkt in pkts:
+                self.send(pkt)
+            return len(pkts)
+
+        frames = [self._encode_frame(pkt) for pkt in pkts]
+        for frame in frames:
+            # The frames are copied to fixed size buffers
+            if len(frame) > CAN_FRAME_SIZE:
+                raise Scapy_Exception("Frame too long for a SocketCAN "
+                                      "frame: %d bytes" % len(frame))
+        if self.send_vector is None:
+            self.send_vector = _MMsgVector(max(len(frames), 64))
+        vector = self.send_vector
+
+        for start in range(0, len(frames), vector.count):
+            chunk = frames[start:start + vector.count]
+            vector.prepare_send(chunk)
+            sent = 0
+            while sent < len(chunk):
+                ret = _sendmmsg(self.outs.fileno(), vector.address(sent),
+                                len(chunk) - sent, 0)
+                if ret < 0:
+                    err = ctypes.get_errno()
+                    raise socket.error(err, os.strerror(err))
+                sent += ret
+        return len(frames)
+
     def close(self):
         self.ins.close()
 
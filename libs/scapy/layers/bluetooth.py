@@ -16,9 +16,10 @@ import struct
 import select
 from ctypes import sizeof
 
+from scapy.compat import orb, raw
 from scapy.config import conf
 from scapy.data import DLT_BLUETOOTH_HCI_H4, DLT_BLUETOOTH_HCI_H4_WITH_PHDR
-from scapy.packet import bind_layers, Packet
+from scapy.packet import bind_layers, NoPayload, Packet
 from scapy.fields import ByteEnumField, ByteField, Field, FieldLenField, \
     FieldListField, FlagsField, BitEnumField, XIntField, IntField, LEShortEnumField, LEShortField, \
     LenField, PacketListField, SignedByteField, StrField, StrFixedLenField, \
@@ -34,16 +35,67 @@ from scapy.utils import lhex, mac2str, str2mac
 from scapy.volatile import RandMAC
 from scapy.modules import six
 
+# Length fields patched by post_build()
+_byte = struct.Struct("B")
+_le_short = struct.Struct("<H")
+# code, id and len of L2CAP_CmdHdr
+_l2cap_cmd_hdr = struct.Struct("<BBH")
+
 
 ##########
 # Fields #
 ##########
 
+# Raw MAC address types accepted by LEMACField and LERemoteMACField
+_raw_mac_types = (six.binary_type, six.text_type)
+
+
+def _le_mac2str(mac):
+    """Same as mac2str(), with the bytes in reverse order"""
+    try:
+        return bytes.fromhex(mac.replace(":", ""))[::-1]
+    except (AttributeError, TypeError, ValueError):
+        # Not a str, or octets without a leading zero
+        return mac2str(mac)[::-1]
+
+
+def _le_str2mac(s):
+    """Same as str2mac(), with the bytes in reverse order"""
+    try:
+        return s[::-1].hex(":")
+    except (AttributeError, TypeError):
+        # Not bytes, or Python < 3.8
+        return str2mac(s[::-1])
+
+
 class XLEShortField(LEShortField):
     def i2repr(self, pkt, x):
         return lhex(self.i2h(pkt, x))
 
 
+class AlignedFlagsField(FlagsField):
+    """FlagsField made of whole bytes, starting on a byte boundary.
+
+    The flags are read in a single int.from_bytes() call instead of the
+    byte per byte loop of BitField.getfield().
+    """
+
+    def getfield(self, pkt, s):
+        nb_bytes, extra_bits = divmod(self.size, 8)
+        if isinstance(s, tuple) or extra_bits or self.rev or \
+                len(s) < nb_bytes:
+            return FlagsField.getfield(self, pkt, s)
+        return s[nb_bytes:], self.m2i(pkt,
+                                      int.from_bytes(s[:nb_bytes], "big"))
+
+
+class LMPFeaturesField(AlignedFlagsField):
+    """64 bits LMP features mask."""
+
+    def __init__(self, name, default, names):
+        AlignedFlagsField.__init__(self, name, default, 64, names)
+
+
 class LEMACField(Field):
     def __init__(self, name, default):
         Field.__init__(self, name, default, "6s")
@@ -51,13 +103,13 @@ class LEMACField(Field):
     def i2m(self, pkt, x):
         if x is None:
             return b"\0\0\0\0\0\0"
-        return mac2str(x)[::-1]
+        return _le_mac2str(x)
 
     def m2i(self, pkt, x):
-        return str2mac(x[::-1])
+        return _le_str2mac(x)
 
     def any2i(self, pkt, x):
-        if isinstance(x, (six.binary_type, six.text_type)) and len(x) == 6:
+        if isinstance(x, _raw_mac_types) and len(x) == 6:
             x = self.m2i(pkt, x)
         return x
 
@@ -78,13 +130,13 @@ class LERemoteMACField(Field):
     def i2m(self, pkt, x):
         if x is None:
             return b"\0\0\0\0"
-        return mac2str(x)[::-1]
+        return _le_mac2str(x)
 
     def m2i(self, pkt, x):
-        return str2mac(x[::-1])
+        return _le_str2mac(x)
 
     def any2i(self, pkt, x):
-        if isinstance(x, (six.binary_type, six.text_type)) and len(x) == 4:
+        if isinstance(x, _raw_mac_types) and len(x) == 4:
             x = self.m2i(pkt, x)
         return x
 
@@ -93,10 +145,286 @@ class LERemoteMACField(Field):
         return x
 
 
+class FixedLenPacketListField(PacketListField):
+    """PacketListField of records that all have the same length.
+
+    Each record is sliced out of the buffer before being dissected, instead
+    of being dissected from all the remaining bytes and then stripped of the
+    next records as padding.
+    """
+    __slots__ = ["record_len"]
+
+    def __init__(self, name, default, cls, record_len):
+        PacketListField.__init__(self, name, default, cls)
+        self.record_len = record_len
+
+    def getfield(self, pkt, s):
+        lst = []
+        for i in range(0, len(s), self.record_len):
+            record = s[i:i + self.record_len]
+            try:
+                p = self.m2i(pkt, record)
+            except Exception:
+                if conf.debug_dissector:
+                    raise
+                p = conf.raw_layer(load=record)
+            lst.append(p)
+        return b"", lst
+
+
+class EIRPacketListField(PacketListField):
+    """PacketListField of the EIR_Hdr of a fixed size extended inquiry
+    response.
+
+    The significant part of the response ends before the first zero length
+    byte, and is followed by zeros.
+    """
+
+    def getfield(self, pkt, s):
+        end = 0
+        while end < len(s) and orb(s[end]):
+            end += orb(s[end]) + 1
+        remain, lst = PacketListField.getfield(self, pkt, s[:end])
+        return remain + s[end:], lst
+
+
+class FixedLenFieldListField(FieldListField):
+    """FieldListField of single numbers, such as 16-bit UUIDs or handles.
+
+    When the list is bounded by its length, or by the end of the layer, all
+    the numbers are read with a single struct call.
+    """
+
+    def getfield(self, pkt, s):
+        field = self.field
+        fmt = field.fmt
+        if self.count_from is not None or len(fmt) != 2 or \
+                type(field).getfield is not Field.getfield or \
+                type(field).m2i is not Field.m2i:
+            return FieldListField.getfield(self, pkt, s)
+        lst, ret = s, b""
+        if self.length_from is not None:
+            len_pkt = self.length_from(pkt)
+            if len_pkt is not None:
+                lst, ret = s[:len_pkt], s[len_pkt:]
+        count, extra = divmod(len(lst), field.sz)
+        if extra:
+            # Let FieldListField fail on the truncated number
+            return FieldListField.getfield(self, pkt, s)
+        return ret, list(struct.unpack("%s%d%s" % (fmt[0], count, fmt[1]),
+                                       lst))
+
+
+class _PacketListSnapshot(bytes):
+    """Bytes a list of packets was dissected from.
+
+    Packet.self_build() compares the fields holding packets to their value
+    at dissection time: the list is unchanged as long as it still builds to
+    the same bytes.
+    """
+
+    __slots__ = []
+
+    def __eq__(self, other):
+        if isinstance(other, list):
+            return b"".join(raw(p) for p in other) == bytes(self)
+        return bytes.__eq__(self, other)
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = bytes.__hash__
+
+
+class SnapshotPacketListField(PacketListField):
+    """PacketListField of a _SnapshotPacket layer, which remembers the bytes
+    of the list instead of a copy of its packets.
+
+    Copying the packets means dissecting them again, and each copied packet
+    copies its own packet lists: nested lists such as the advertising
+    reports and their EIR elements spend most of their dissection time
+    there.
+    """
+
+    def do_copy(self, x):
+        if isinstance(x, _PacketListSnapshot):
+            return x
+        return PacketListField.do_copy(self, x)
+
+
 ##########
 # Layers #
 ##########
 
+class _FixedLayoutPacket(Packet):
+    """Packet made only of fixed size fields, all dissected with a single
+    struct call.
+
+    The struct is built from fields_desc on the first dissection. Runs of
+    BitFields filling one byte are read as one byte, and split with shifts
+    and masks. Layers that cannot be described by one struct, and truncated
+    inputs, go through Packet.do_dissect() instead.
+    """
+
+    @classmethod
+    def _build_layout(cls):
+        order = None
+        fmt = ""
+        names = []
+        converters = []
+        bits = []
+        nbits = 0
+        for f in cls.fields_desc:
+            if isinstance(f, BitField):
+                if type(f).getfield is not BitField.getfield or \
+                        type(f).m2i is not Field.m2i or f.rev:
+                    return None
+                bits.append((f.name, f.size))
+                nbits += f.size
+                if nbits < 8:
+                    continue
+                if nbits > 8:
+                    return None
+                # The first BitField holds the most significant bits
+                run = []
+                for name, size in bits:
+                    nbits -= size
+                    run.append((name, nbits, (1 << size) - 1))
+                fmt += "B"
+                names.append(tuple(run))
+                bits = []
+                continue
+            if bits or type(f).getfield is not Field.getfield or f.islist or \
+                    f.holds_packets or f.ismutable or f.fmt[0] not in "<>!":
+                return None
+            if f.sz > 1 and f.fmt[-1] != "s":
+                f_order = "<" if f.fmt[0] == "<" else ">"
+                if order not in (None, f_order):
+                    return None
+                order = f_order
+            fmt += f.fmt[1:]
+            names.append(f.name)
+            if type(f).m2i is not Field.m2i:
+                converters.append(f)
+        if bits:
+            return None
+        has_bits = any(isinstance(name, tuple) for name in names)
+        return (struct.Struct((order or "<") + fmt), names, converters,
+                has_bits)
+
+    def do_dissect(self, s):
+        cls = self.__class__
+        try:
+            layout = cls.__dict__["_fixed_layout"]
+        except KeyError:
+            layout = cls._fixed_layout = cls._build_layout()
+        if layout is None or len(s) < layout[0].size:
+            return Packet.do_dissect(self, s)
+        fixed_struct, names, converters, has_bits = layout
+        fields = self.fields
+        if has_bits:
+            for name, value in zip(names, fixed_struct.unpack_from(s)):
+                if name.__class__ is tuple:
+                    for bit_name, shift, mask in name:
+                        fields[bit_name] = value >> shift & mask
+                else:
+                    fields[name] = value
+        else:
+            fields.update(zip(names, fixed_struct.unpack_from(s)))
+        for f in converters:
+            fields[f.name] = f.m2i(self, fields[f.name])
+        size = fixed_struct.size
+        self.raw_packet_cache = s[:size]
+        self.raw_packet_cache_fields = {}
+        self.explicit = 1
+        return s[size:]
+
+
+class _MemoizedPayloadPacket(Packet):
+    """Packet whose payload class, found by Packet.guess_payload_class(), is
+    memoized by the values of the fields used in its payload bindings.
+
+    bind_layers() and split_layers() replace the payload_guess lists, which
+    drops the memoized classes. Bindings on other names than fields of the
+    layer are not memoized.
+    """
+
+    def guess_payload_class(self, payload):
+        cls = self.__class__
+        guesses = [t.payload_guess for t in self.aliastypes]
+        try:
+            memo = cls.__dict__["_payload_memo"]
+        except KeyError:
+            memo = None
+        if memo is None or memo[0] != guesses:
+            keys = set()
+            for payload_guess in guesses:
+                for fval, _ in payload_guess:
+                    keys.update(fval)
+            keys = tuple(sorted(keys))
+            classes = {}
+            if not keys or any(k not in self.fieldtype for k in keys):
+                classes = None
+            memo = cls._payload_memo = (guesses, keys, classes)
+        _, keys, classes = memo
+        if classes is None:
+            return Packet.guess_payload_class(self, payload)
+        key = tuple([self.getfieldval(k) for k in keys])
+        try:
+            pay_cls = classes[key]
+        except KeyError:
+            pay_cls = Packet.guess_payload_class(self, payload)
+            if pay_cls is self.default_payload_class(payload):
+                # Not bound: do not memoize conf.raw_layer
+                pay_cls = None
+            classes[key] = pay_cls
+        except TypeError:
+            # Unhashable field value
+            return Packet.guess_payload_class(self, payload)
+        if pay_cls is None:
+            return self.default_payload_class(payload)
+        return pay_cls
+
+
+class _SnapshotPacket(Packet):
+    """Packet holding SnapshotPacketListFields, whose dissected bytes are
+    kept to tell whether they were modified."""
+
+    def do_dissect(self, s):
+        _raw = s
+        self.raw_packet_cache_fields = {}
+        for f in self.fields_desc:
+            if not s:
+                break
+            field_raw = s
+            s, fval = f.getfield(self, s)
+            if isinstance(f, SnapshotPacketListField):
+                self.raw_packet_cache_fields[f.name] = _PacketListSnapshot(
+                    field_raw[:len(field_raw) - len(s)])
+            elif f.islist or f.holds_packets or f.ismutable:
+                self.raw_packet_cache_fields[f.name] = f.do_copy(fval)
+            self.fields[f.name] = fval
+        self.raw_packet_cache = _raw[:-len(s)] if s else _raw
+        self.explicit = 1
+        return s
+
+
+def _get_layer(pkt, cls):
+    """Returns the first layer of pkt whose class is cls, or None.
+
+    Unlike pkt.getlayer(), layers held in packet fields are not searched:
+    answers() only looks for command headers, which never are.
+    """
+    while not isinstance(pkt, NoPayload):
+        if pkt.__class__ is cls:
+            return pkt
+        pkt = pkt.payload
+    return None
+
+
 # See bluez/lib/hci.h for details
 
 # Transport layers
@@ -396,35 +724,27 @@ _bluetooth_lmp_features = [
     "3slot", "5slot", "enc", "slotoff", "timacc", "rolesw", "holdmo", "sniffmo",  # First octet
 ]
 
-_bluetooth_lmp_ext_features_1 = [
+# Features 16 to 63, unused on the extended feature pages
+_bluetooth_lmp_features_unused_16_63 = [
     "un48", "un49", "un50", "un51", "un52", "un53", "un54", "un55",
     "un56", "un57", "un58", "un59", "un60", "un61", "un62", "un63",
     "un40", "un41", "un42", "un43", "un44", "un45", "un46", "un47",
     "un32", "un33", "un34", "un35", "un36", "un37", "un38", "un39",
     "un24", "un25", "un26", "un27", "un28", "un29", "un30", "un31",
     "un16", "un17", "un18", "un19", "un20", "un21", "un22", "un23",
+]
+
+_bluetooth_lmp_ext_features_1 = _bluetooth_lmp_features_unused_16_63 + [
     "un8", "un9", "un10", "un11", "un12", "un13", "un14", "un15",
     "ssp", "lesup", "lebredr", "sch", "un4", "un5", "un6", "un7",  # First octet
 ]
 
-_bluetooth_lmp_ext_features_2 = [
-    "un48", "un49", "un50", "un51", "un52", "un53", "un54", "un55",
-    "un56", "un57", "un58", "un59", "un60", "un61", "un62", "un63",
-    "un40", "un41", "un42", "un43", "un44", "un45", "un46", "un47",
-    "un32", "un33", "un34", "un35", "un36", "un37", "un38", "un39",
-    "un24", "un25", "un26", "un27", "un28", "un29", "un30", "un31",
-    "un16", "un17", "un18", "un19", "un20", "un21", "un22", "un23",
+_bluetooth_lmp_ext_features_2 = _bluetooth_lmp_features_unused_16_63 + [
     "scc", "ping", "res1", "trnud", "sam", "un13", "un14", "un15",
     "csbma", "csbsl", "syntr", "synsc", "inqresnote", "genintsc", "ccadj", "res0",  # First octet
 ]
 
-_bluetooth_lmp_features_unused = [
-    "un48", "un49", "un50", "un51", "un52", "un53", "un54", "un55",
-    "un56", "un57", "un58", "un59", "un60", "un61", "un62", "un63",
-    "un40", "un41", "un42", "un43", "un44", "un45", "un46", "un47",
-    "un32", "un33", "un34", "un35", "un36", "un37", "un38", "un39",
-    "un24", "un25", "un26", "un27", "un28", "un29", "un30", "un31",
-    "un16", "un17", "un18", "un19", "un20", "un21", "un22", "un23",
+_bluetooth_lmp_features_unused = _bluetooth_lmp_features_unused_16_63 + [
     "un8", "un9", "un10", "un11", "un12", "un13", "un14", "un15",
     "un0", "un1", "un2", "un3", "un4", "un5", "un6", "un7",  # First octet
 ]
@@ -436,6 +756,16 @@ _bluetooth_lmp_power_adjustment_res = {
     3: "min power"
 }
 
+_bluetooth_lmp_paging_scheme = {
+    0: "mandatory"
+}
+
+_bluetooth_lmp_paging_scheme_settings = {
+    0: "R0",
+    1: "R1",
+    2: "R2"
+}
+
 _bluetooth_diag_types = {
     0: "LM_SENT",
     1: "LM_RECV",
@@ -447,7 +777,7 @@ _bluetooth_diag_types = {
 }
 
 
-class HCI_Hdr(Packet):
+class HCI_Hdr(_MemoizedPayloadPacket):
     name = "HCI header"
     fields_desc = [ByteEnumField("type", 2, _bluetooth_packet_types)]
 
@@ -466,33 +796,40 @@ class HCI_ACL_Hdr(Packet):
                    LEShortField("len", None), ]
 
     def pre_dissect(self, s):
-        return s[:2][::-1] + s[2:]  # Reverse the 2 first bytes
+        return s[1::-1] + s[2:]  # Reverse the 2 first bytes
 
     def post_dissect(self, s):
-        self.raw_packet_cache = None  # Reset packet to allow post_build
+        # The cached header was reversed by pre_dissect: restore the wire
+        # order, instead of dropping it and building the header again.
+        # Truncated headers are still built again, which sets len.
+        cache = self.raw_packet_cache
+        if cache is not None:
+            if len(cache) < 4:
+                self.raw_packet_cache = None
+            else:
+                self.raw_packet_cache = cache[1::-1] + cache[2:]
         return s
 
     def post_build(self, p, pay):
-        p += pay
+        # Patch the header before appending the payload, to copy it once
         if self.len is None:
-            p = p[:2] + struct.pack("<H", len(pay)) + p[4:]
+            p = p[:2] + _le_short.pack(len(pay)) + p[4:]
         # Reverse, opposite of pre_dissect
-        return p[:2][::-1] + p[2:]  # Reverse (again) the 2 first bytes
+        return p[1::-1] + p[2:] + pay  # Reverse (again) the 2 first bytes
 
 
-class L2CAP_Hdr(Packet):
+class L2CAP_Hdr(_MemoizedPayloadPacket):
     name = "L2CAP header"
     fields_desc = [LEShortField("len", None),
                    LEShortEnumField("cid", 0, {1: "control", 4: "attribute"}), ]  # noqa: E501
 
     def post_build(self, p, pay):
-        p += pay
         if self.len is None:
-            p = struct.pack("<H", len(pay)) + p[2:]
-        return p
+            p = _le_short.pack(len(pay)) + p[2:]
+        return p + pay
 
 
-class L2CAP_CmdHdr(Packet):
+class L2CAP_CmdHdr(_MemoizedPayloadPacket):
     name = "L2CAP command header"
     fields_desc = [
         ByteEnumField("code", 8, {1: "rej", 2: "conn_req", 3: "conn_resp",
@@ -503,11 +840,22 @@ class L2CAP_CmdHdr(Packet):
         ByteField("id", 0),
         LEShortField("len", None)]
 
+    def do_dissect(self, s):
+        if len(s) < 4:
+            return Packet.do_dissect(self, s)
+        # The 3 fields are read at once, as Packet.do_dissect() would
+        fields = self.fields
+        fields["code"], fields["id"], fields["len"] = \
+            _l2cap_cmd_hdr.unpack_from(s)
+        self.raw_packet_cache_fields = {}
+        self.raw_packet_cache = s[:4]
+        self.explicit = 1
+        return s[4:]
+
     def post_build(self, p, pay):
-        p += pay
         if self.len is None:
-            p = p[:2] + struct.pack("<H", len(pay)) + p[4:]
-        return p
+            p = p[:2] + _le_short.pack(len(pay)) + p[4:]
+        return p + pay
 
     def answers(self, other):
         if other.id == self.id:
@@ -612,7 +960,7 @@ class L2CAP_Connection_Parameter_Update_Response(Packet):
     fields_desc = [LEShortField("move_result", 0), ]
 
 
-class ATT_Hdr(Packet):
+class ATT_Hdr(_MemoizedPayloadPacket):
     name = "ATT header"
     fields_desc = [XByteField("opcode", None), ]
 
@@ -663,16 +1011,16 @@ class ATT_Find_Information_Response(Packet):
     fields_desc = [
         XByteField("format", 1),
         ConditionalField(
-            PacketListField(
+            FixedLenPacketListField(
                 "handles", [],
-                ATT_Handle,
+                ATT_Handle, 4,
             ),
             lambda pkt: pkt.format == 1
         ),
         ConditionalField(
-            PacketListField(
+            FixedLenPacketListField(
                 "handles", [],
-                ATT_Handle_UUID128,
+                ATT_Handle_UUID128, 18,
             ),
             lambda pkt: pkt.format == 2
         )]
@@ -688,7 +1036,7 @@ class ATT_Find_By_Type_Value_Request(Packet):
 
 class ATT_Find_By_Type_Value_Response(Packet):
     name = "Find By Type Value Response"
-    fields_desc = [PacketListField("handles", [], ATT_Handle)]
+    fields_desc = [FixedLenPacketListField("handles", [], ATT_Handle, 4)]
 
 
 class ATT_Read_By_Type_Request_128bit(Packet):
@@ -736,13 +1084,18 @@ class ATT_Read_By_Type_Response(Packet):
                            pkt._next_cls_cb(pkt, *args)
                        ))]
 
+    # ATT_Handle_Variable constructors, by record length
+    _handle_cls_cache = {}
+
     @classmethod
     def _next_cls_cb(cls, pkt, lst, p, remain):
         if len(remain) >= pkt.len:
-            return functools.partial(
-                ATT_Handle_Variable,
-                val_length=pkt.len - 2
-            )
+            handle_cls = cls._handle_cls_cache.get(pkt.len)
+            if handle_cls is None:
+                handle_cls = functools.partial(ATT_Handle_Variable,
+                                               val_length=pkt.len - 2)
+                cls._handle_cls_cache[pkt.len] = handle_cls
+            return handle_cls
         return None
 
 
@@ -758,7 +1111,8 @@ class ATT_Read_Response(Packet):
 
 class ATT_Read_Multiple_Request(Packet):
     name = "Read Multiple Request"
-    fields_desc = [FieldListField("handles", [], XLEShortField("", 0))]
+    fields_desc = [FixedLenFieldListField("handles", [],
+                                          XLEShortField("", 0))]
 
 
 class ATT_Read_Multiple_Response(Packet):
@@ -851,12 +1205,12 @@ class ATT_Handle_Value_Indication(Packet):
     ]
 
 
-class SM_Hdr(Packet):
+class SM_Hdr(_MemoizedPayloadPacket):
     name = "SM header"
     fields_desc = [ByteField("sm_command", None)]
 
 
-class SM_Pairing_Request(Packet):
+class SM_Pairing_Request(_FixedLayoutPacket):
     name = "Pairing Request"
     fields_desc = [ByteEnumField("iocap", 3,
                                  {0: "DisplayOnly", 1: "DisplayYesNo", 2: "KeyboardOnly", 3: "NoInputNoOutput",
@@ -868,7 +1222,7 @@ class SM_Pairing_Request(Packet):
                    ByteField("responder_key_distribution", 0), ]
 
 
-class SM_Pairing_Response(Packet):
+class SM_Pairing_Response(_FixedLayoutPacket):
     name = "Pairing Response"
     fields_desc = [ByteEnumField("iocap", 3,
                                  {0: "DisplayOnly", 1: "DisplayYesNo", 2: "KeyboardOnly", 3: "NoInputNoOutput",
@@ -933,7 +1287,7 @@ class SM_DHKey_Check(Packet):
     fields_desc = [StrFixedLenField("dhkey_check", b'\x00' * 16, 16), ]
 
 
-class EIR_Hdr(Packet):
+class EIR_Hdr(_MemoizedPayloadPacket):
     name = "EIR Header"
     fields_desc = [
         LenField("len", None, fmt="B", adjust=lambda x: x + 1),  # Add bytes mark  # noqa: E501
@@ -1001,11 +1355,12 @@ class EIR_Element(Packet):
 
     @staticmethod
     def length_from(pkt):
-        if not pkt.underlayer:
+        underlayer = pkt.underlayer
+        if underlayer is None:
             warning("Missing an upper-layer")
             return 0
         # 'type' byte is included in the length, so subtract 1:
-        return pkt.underlayer.len - 1
+        return underlayer.getfieldval("len") - 1
 
 
 class EIR_Raw(EIR_Element):
@@ -1018,10 +1373,10 @@ class EIR_Raw(EIR_Element):
 class EIR_Flags(EIR_Element):
     name = "Flags"
     fields_desc = [
-        FlagsField("flags", 0x2, 8,
-                   ["limited_disc_mode", "general_disc_mode",
-                    "br_edr_not_supported", "simul_le_br_edr_ctrl",
-                    "simul_le_br_edr_host"] + 3 * ["reserved"])
+        AlignedFlagsField("flags", 0x2, 8,
+                          ["limited_disc_mode", "general_disc_mode",
+                           "br_edr_not_supported", "simul_le_br_edr_ctrl",
+                           "simul_le_br_edr_host"] + 3 * ["reserved"])
     ]
 
 
@@ -1029,8 +1384,8 @@ class EIR_CompleteList16BitServiceUUIDs(EIR_Element):
     name = "Complete list of 16-bit service UUIDs"
     fields_desc = [
         # https://www.bluetooth.com/specifications/assigned-numbers/16-bit-uuids-for-members
-        FieldListField("svc_uuids", None, XLEShortField("uuid", 0),
-                       length_from=EIR_Element.length_from)
+        FixedLenFieldListField("svc_uuids", None, XLEShortField("uuid", 0),
+                               length_from=EIR_Element.length_from)
     ]
 
 
@@ -1075,9 +1430,12 @@ class EIR_Manufacturer_Specific_Data(EIR_Element):
     ]
 
     registered_magic_payloads = {}
+    registered_magic_prefixes = {}
+    _magic_prefix_lens = []
 
     @classmethod
-    def register_magic_payload(cls, payload_cls, magic_check=None):
+    def register_magic_payload(cls, payload_cls, magic_check=None,
+                               magic_prefix=None):
         """
         Registers a payload type that uses magic data.
 
@@ -1104,9 +1462,22 @@ class EIR_Manufacturer_Specific_Data(EIR_Element):
             (optional) callable to use to if a payload should be associated
             with this type. If not supplied, ``payload_cls.magic_check`` is
             used instead.
-        :raises TypeError: If ``magic_check`` is not specified,
-                           and ``payload_cls.magic_check`` is not implemented.
+        :param bytes magic_prefix:
+            (optional) bytes that every payload of this type starts with.
+            Such payloads are found with a dictionary lookup, before any
+            ``magic_check`` is called, and ``magic_check`` is not used.
+        :raises TypeError: If neither ``magic_check`` nor ``magic_prefix`` is
+                           specified, and ``payload_cls.magic_check`` is not
+                           implemented.
         """
+        if magic_prefix is not None:
+            cls.registered_magic_prefixes[magic_prefix] = payload_cls
+            if len(magic_prefix) not in cls._magic_prefix_lens:
+                # Try the longest, most specific, prefixes first
+                cls._magic_prefix_lens.append(len(magic_prefix))
+                cls._magic_prefix_lens.sort(reverse=True)
+            return
+
         if magic_check is None:
             if hasattr(payload_cls, "magic_check"):
                 magic_check = payload_cls.magic_check
@@ -1117,8 +1488,14 @@ class EIR_Manufacturer_Specific_Data(EIR_Element):
         cls.registered_magic_payloads[payload_cls] = magic_check
 
     def default_payload_class(self, payload):
-        for cls, check in six.iteritems(
-                EIR_Manufacturer_Specific_Data.registered_magic_payloads):
+        prefixes = EIR_Manufacturer_Specific_Data.registered_magic_prefixes
+        for plen in EIR_Manufacturer_Specific_Data._magic_prefix_lens:
+            cls = prefixes.get(payload[:plen])
+            if cls is not None:
+                return cls
+
+        payloads = EIR_Manufacturer_Specific_Data.registered_magic_payloads
+        for cls, check in payloads.items():
             if check(payload):
                 return cls
 
@@ -1153,7 +1530,7 @@ class EIR_ServiceData16BitUUID(EIR_Element):
         return s[:plen], s[plen:]
 
 
-class BT_LMP(Packet):
+class BT_LMP(_MemoizedPayloadPacket):
     name = "Bluetooth Link Manager Protocol"
     fields_desc = [
         BitEnumField("opcode", 0, 7, _bluetooth_lmp_opcode),
@@ -1162,6 +1539,28 @@ class BT_LMP(Packet):
                          lambda pkt: pkt.opcode == 127),
     ]
 
+    def do_dissect(self, s):
+        # Split the opcode byte with shifts instead of the BitField loop
+        if not s:
+            return Packet.do_dissect(self, s)
+        opcode_tid = orb(s[0])
+        fields = self.fields
+        fields["opcode"] = opcode = opcode_tid >> 1
+        fields["tid"] = opcode_tid & 1
+        size = 1
+        if len(s) > 1:
+            if opcode == 127:
+                fields["ext_opcode"] = orb(s[1])
+                size = 2
+            else:
+                # Like the ConditionalField: the ext_opcode payload bindings
+                # rely on it
+                fields["ext_opcode"] = None
+        self.raw_packet_cache = s[:size]
+        self.raw_packet_cache_fields = {}
+        self.explicit = 1
+        return s[size:]
+
     # Override default dissection function to include empty packet types
     def do_dissect_payload(self, s):
         cls = self.guess_payload_class(s)
@@ -1170,21 +1569,28 @@ class BT_LMP(Packet):
             self.add_payload(p)
 
 
-class LMP_features_req(Packet):
-    name = "LMP_features_req"
-    fields_desc = [FlagsField(
-        "features", 0x8f7bffdbfecffebf, 64, _bluetooth_lmp_features)]
+class _LMP_PDU(Packet):
+    """Base class of the LMP PDUs.
+
+    The PDUs are carried in fixed size baseband payloads: whatever follows
+    their fields is padding, and is dropped.
+    """
 
     def post_dissect(self, s):
-        # Truncate padding
-        return ""
+        return b""
+
+
+class LMP_features_req(_LMP_PDU):
+    name = "LMP_features_req"
+    fields_desc = [LMPFeaturesField(
+        "features", 0x8f7bffdbfecffebf, _bluetooth_lmp_features)]
 
 
 class LMP_features_res(LMP_features_req):
     name = "LMP_features_res"
 
 
-class LMP_version_req(Packet):
+class LMP_version_req(_LMP_PDU):
     name = "LMP_version_req"
     fields_desc = [
         # Version 4.2 by default
@@ -1193,50 +1599,38 @@ class LMP_version_req(Packet):
         LEShortField("subversion", 24841)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
 class LMP_version_res(LMP_version_req):
     name = "LMP_version_res"
 
 
-class LMP_features_req_ext(Packet):
+class LMP_features_req_ext(_LMP_PDU):
     name = "LMP_features_req_ext"
     fields_desc = [ByteEnumField("fpage", 1, {0: "standard features",
                                               1: "extended features 64-67",
                                               2: "extended features 128-140"}),
                    ByteField("max_page", 2),
-                   ConditionalField(FlagsField("features0", 0, 64, _bluetooth_lmp_features),
+                   ConditionalField(LMPFeaturesField("features0", 0, _bluetooth_lmp_features),
                                     lambda pkt: pkt.fpage == 0),
-                   ConditionalField(FlagsField("features1", 0, 64, _bluetooth_lmp_ext_features_1),
+                   ConditionalField(LMPFeaturesField("features1", 0, _bluetooth_lmp_ext_features_1),
                                     lambda pkt: pkt.fpage == 1),
-                   ConditionalField(FlagsField("features2", 0, 64, _bluetooth_lmp_ext_features_2),
+                   ConditionalField(LMPFeaturesField("features2", 0, _bluetooth_lmp_ext_features_2),
                                     lambda pkt: pkt.fpage == 2),
-                   ConditionalField(FlagsField("features", 0, 64, _bluetooth_lmp_ext_features_2),
+                   ConditionalField(LMPFeaturesField("features", 0, _bluetooth_lmp_ext_features_2),
                                     lambda pkt: pkt.fpage > 2),
                    ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
 class LMP_features_res_ext(LMP_features_req_ext):
     name = "LMP_features_res_ext"
 
 
-class LMP_name_req(Packet):
+class LMP_name_req(_LMP_PDU):
     name = "LMP_name_req"
     fields_desc = [ByteField("name_offset", 0)]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_name_res(Packet):
+class LMP_name_res(_LMP_PDU):
     name = "LMP_name_res"
     fields_desc = [
         ByteField("name_offset", 0),
@@ -1244,42 +1638,26 @@ class LMP_name_res(Packet):
         StrLenField("name_frag", "", length_from=lambda pkt: pkt.name_len),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_detach(Packet):
+class LMP_detach(_LMP_PDU):
     name = "LMP_detach"
     fields_desc = [ByteEnumField(
         "error_code", 0x13, _bluetooth_lmp_error_code)]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_host_connection_req(Packet):
+class LMP_host_connection_req(_LMP_PDU):
     name = "LMP_host_connection_req"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_accepted(Packet):
+class LMP_accepted(_LMP_PDU):
     name = "LMP_accepted"
     fields_desc = [
         BitField("unused", 0, 1),
         BitEnumField("code", 51, 7, _bluetooth_lmp_opcode),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_not_accepted(Packet):
+class LMP_not_accepted(_LMP_PDU):
     name = "LMP_not_accepted"
     fields_desc = [
         BitField("unused", 0, 1),
@@ -1287,23 +1665,15 @@ class LMP_not_accepted(Packet):
         ByteEnumField("error_code", 6, _bluetooth_lmp_error_code)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_au_rand(Packet):
+class LMP_au_rand(_LMP_PDU):
     name = "LMP_au_rand"
     fields_desc = [
         StrFixedLenField("rand", b"\x00" * 16, 16)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_encapsulated_header(Packet):
+class LMP_encapsulated_header(_LMP_PDU):
     name = "LMP_encapsulated_header"
     fields_desc = [
         ByteField("major_type", 1),
@@ -1311,67 +1681,43 @@ class LMP_encapsulated_header(Packet):
         ByteField("enc_len", 48),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_encapsulated_payload(Packet):
+class LMP_encapsulated_payload(_LMP_PDU):
     name = "LMP_encapsulated_payload"
     fields_desc = [
         StrFixedLenField("data", b"\x00" * 16, 16)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_Simple_Pairing_Confirm(Packet):
+class LMP_Simple_Pairing_Confirm(_LMP_PDU):
     name = "LMP_Simple_Pairing_Confirm"
     fields_desc = [
         StrFixedLenField("commit", b"\x00" * 16, 16)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_Simple_Pairing_Number(Packet):
+class LMP_Simple_Pairing_Number(_LMP_PDU):
     name = "LMP_Simple_Pairing_Number"
     fields_desc = [
         StrFixedLenField("nonce", b"\x00" * 16, 16)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_DHkey_Check(Packet):
+class LMP_DHkey_Check(_LMP_PDU):
     name = "LMP_DHkey_Check"
     fields_desc = [
         StrFixedLenField("confirm", b"\x00" * 16, 16)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_sres(Packet):
+class LMP_sres(_LMP_PDU):
     name = "LMP_sres"
     fields_desc = [
         StrFixedLenField("authres", b"\x00" * 4, 4)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_encryption_mode_req(Packet):
+class LMP_encryption_mode_req(_LMP_PDU):
     name = "LMP_encryption_mode_req"
     fields_desc = [
         ByteEnumField("mode", 1, {
@@ -1381,60 +1727,36 @@ class LMP_encryption_mode_req(Packet):
         })
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_encryption_key_size_req(Packet):
+class LMP_encryption_key_size_req(_LMP_PDU):
     name = "LMP_encryption_key_size_req"
     fields_desc = [ByteField("keysize", 16)]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_start_encryption_req(Packet):
+class LMP_start_encryption_req(_LMP_PDU):
     name = "LMP_start_encryption_req"
     fields_desc = [
         StrFixedLenField("rand", b"\x00" * 16, 16)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_stop_encryption_req(Packet):
+class LMP_stop_encryption_req(_LMP_PDU):
     name = "LMP_stop_encryption_req"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_setup_complete(Packet):
+class LMP_setup_complete(_LMP_PDU):
     name = "LMP_setup_complete"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_packet_type_table_req(Packet):
+class LMP_packet_type_table_req(_LMP_PDU):
     name = "LMP_packet_type_table_req"
     fields_desc = [ByteEnumField("pkt_type_table", 1, {
         0: "1 Mbps only",
         1: "2/3 Mbps",
     })]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_accepted_ext(Packet):
+class LMP_accepted_ext(_LMP_PDU):
     name = "LMP_accepted_ext"
     fields_desc = [
         BitField("unused", 0, 1),
@@ -1442,12 +1764,8 @@ class LMP_accepted_ext(Packet):
         ByteEnumField("code2", 11, _bluetooth_lmp_ext_opcode)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_not_accepted_ext(Packet):
+class LMP_not_accepted_ext(_LMP_PDU):
     name = "LMP_accepted_ext"
     fields_desc = [
         BitField("unused", 0, 1),
@@ -1456,12 +1774,8 @@ class LMP_not_accepted_ext(Packet):
         ByteEnumField("error_code", 6, _bluetooth_lmp_error_code),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_set_AFH(Packet):
+class LMP_set_AFH(_LMP_PDU):
     name = "LMP_set_AFH"
     fields_desc = [
         LEIntField("instant", 0x00011cee),
@@ -1473,12 +1787,8 @@ class LMP_set_AFH(Packet):
             "chM", b'\xff\xff\xff\xff\xff\xff\xff\xff\xff\x7f', 10),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_channel_classification_req(Packet):
+class LMP_channel_classification_req(_LMP_PDU):
     name = "LMP_channel_classification_req"
     fields_desc = [
         ByteEnumField("mode", 1, {
@@ -1489,55 +1799,35 @@ class LMP_channel_classification_req(Packet):
         LEShortField("max_interval", 0xbb80),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_channel_classification(Packet):
+class LMP_channel_classification(_LMP_PDU):
     name = "LMP_channel_classification"
     fields_desc = [XStrFixedLenField(
         "class", b'\xff\xff\xff\xff\xff\xff\xff\xff\xff\x7f', 10)]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_max_slot_req(Packet):
+class LMP_max_slot_req(_LMP_PDU):
     name = "LMP_max_slot_req"
     fields_desc = [ByteField("max_slots", 5)]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
 class LMP_max_slot(LMP_max_slot_req):
     name = "LMP_max_slot"
 
 
-class LMP_clkoffset_req(Packet):
+class LMP_clkoffset_req(_LMP_PDU):
     name = "LMP_clkoffset_req"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_clkoffset_res(Packet):
+class LMP_clkoffset_res(_LMP_PDU):
     name = "LMP_clkoffset_res"
     fields_desc = [LEShortField("offset", 9450)]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_sniff_req(Packet):
+class LMP_sniff_req(_LMP_PDU):
     name = "LMP_sniff_req"
     fields_desc = [
-        FlagsField("timectr", 0x02, 8, [
+        AlignedFlagsField("timectr", 0x02, 8, [
                    "change", "init", "accwin", "un3", "un4", "un5", "un6", "un7"]),
         LEShortField("dsniff", 0),
         LEShortField("tsniff", 0x31e),
@@ -1545,36 +1835,20 @@ class LMP_sniff_req(Packet):
         LEShortField("sniff_timeout", 1),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_unsniff_req(Packet):
+class LMP_unsniff_req(_LMP_PDU):
     name = "LMP_unsniff_req"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_max_power(Packet):
+class LMP_max_power(_LMP_PDU):
     name = "LMP_max_power"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_min_power(Packet):
+class LMP_min_power(_LMP_PDU):
     name = "LMP_min_power"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_power_control_req(Packet):
+class LMP_power_control_req(_LMP_PDU):
     name = "LMP_power_control_req"
     fields_desc = [ByteEnumField("poweradj", 0, {
         0: "decrement power one step",
@@ -1582,12 +1856,8 @@ class LMP_power_control_req(Packet):
         2: "increase to maximum power"
     })]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_power_control_res(Packet):
+class LMP_power_control_res(_LMP_PDU):
     name = "LMP_power_control_res"
     fields_desc = [
         BitField("unused", 0, 2),
@@ -1596,20 +1866,12 @@ class LMP_power_control_res(Packet):
         BitEnumField("p_gfsk", 1, 2, _bluetooth_lmp_power_adjustment_res),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_auto_rate(Packet):
+class LMP_auto_rate(_LMP_PDU):
     name = "LMP_auto_rate"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_preferred_rate(Packet):
+class LMP_preferred_rate(_LMP_PDU):
     name = "LMP_preferred_rate"
     fields_desc = [
         BitField("rfu", 0, 1),
@@ -1637,75 +1899,43 @@ class LMP_preferred_rate(Packet):
         }),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_timing_accuracy_req(Packet):
+class LMP_timing_accuracy_req(_LMP_PDU):
     name = "LMP_timing_accuracy_req"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_timing_accuracy_res(Packet):
+class LMP_timing_accuracy_res(_LMP_PDU):
     name = "LMP_timing_accuracy_res"
     fields_desc = [
         ByteField("drift", 45),
         ByteField("jitter", 10)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_page_scan_mode_req(Packet):
+class LMP_page_scan_mode_req(_LMP_PDU):
     name = "LMP_page_scan_mode_req"
     fields_desc = [
-        ByteEnumField("scheme", 45, {0: "mandatory"}),
-        ByteEnumField("settings", 10, {
-            0: "R0",
-            1: "R1",
-            2: "R2"
-        })
+        ByteEnumField("scheme", 45, _bluetooth_lmp_paging_scheme),
+        ByteEnumField("settings", 10, _bluetooth_lmp_paging_scheme_settings)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_page_mode_req(Packet):
+class LMP_page_mode_req(_LMP_PDU):
     name = "LMP_page_mode_req"
     fields_desc = [
-        ByteEnumField("scheme", 45, {0: "mandatory"}),
-        ByteEnumField("settings", 10, {
-            0: "R0",
-            1: "R1",
-            2: "R2"
-        })
+        ByteEnumField("scheme", 45, _bluetooth_lmp_paging_scheme),
+        ByteEnumField("settings", 10, _bluetooth_lmp_paging_scheme_settings)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_supervision_timeout(Packet):
+class LMP_supervision_timeout(_LMP_PDU):
     name = "LMP_supervision_timeout"
     fields_desc = [
         LEShortField("timeout", 8000)
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_sniff_subrating_req(Packet):
+class LMP_sniff_subrating_req(_LMP_PDU):
     name = "LMP_sniff_subrating_req"
     fields_desc = [
         ByteField("max_sniff_subrate", 1),
@@ -1713,32 +1943,20 @@ class LMP_sniff_subrating_req(Packet):
         LEShortField("subrating_instant", 42432),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
 class LMP_sniff_subrating_res(LMP_sniff_subrating_req):
     name = "LMP_sniff_subrating_res"
 
 
-class LMP_pause_encryption_req(Packet):
+class LMP_pause_encryption_req(_LMP_PDU):
     name = "LMP_pause_encryption_req"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
 
-
-class LMP_resume_encryption_req(Packet):
+class LMP_resume_encryption_req(_LMP_PDU):
     name = "LMP_resume_encryption_req"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_IO_Capability_req(Packet):
+class LMP_IO_Capability_req(_LMP_PDU):
     name = "LMP_IO_Capability_req"
     fields_desc = [
         ByteEnumField("io_cap", 0x03, {
@@ -1763,56 +1981,32 @@ class LMP_IO_Capability_req(Packet):
         }),
     ]
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
 class LMP_IO_Capability_res(LMP_IO_Capability_req):
     name = "LMP_IO_Capability_res"
 
 
-class LMP_numeric_comparison_failed(Packet):
+class LMP_numeric_comparison_failed(_LMP_PDU):
     name = "LMP_IO_Capability_res"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_passkey_failed(Packet):
+class LMP_passkey_failed(_LMP_PDU):
     name = "LMP_passkey_failed"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_oob_failed(Packet):
+class LMP_oob_failed(_LMP_PDU):
     name = "LMP_oob_failed"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_ping_req(Packet):
+class LMP_ping_req(_LMP_PDU):
     name = "LMP_ping_req"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class LMP_ping_res(Packet):
+class LMP_ping_res(_LMP_PDU):
     name = "LMP_ping_res"
 
-    def post_dissect(self, s):
-        # Truncate padding
-        return ""
-
 
-class ESP32_BREDR(Packet):
+class ESP32_BREDR(_FixedLayoutPacket):
     name = "ESP32_BREDR"
     fields_desc = [
         
@@ -1827,7 +2021,7 @@ class ESP32_BREDR(Packet):
         BitField("is_edr", 0, 1),
     ]
 
-class BT_Baseband(Packet):
+class BT_Baseband(_FixedLayoutPacket):
     name = "BT_Baseband"
     fields_desc = [
 
@@ -1847,13 +2041,13 @@ class BT_Baseband(Packet):
     ]
 
     def guess_payload_class(self, payload):
-        if self.type == 0x04 or self.type == 0x08:
-            return BT_ACL_Hdr
-        else:
+        cls = _bt_baseband_payload_classes.get(self.getfieldval("type"))
+        if cls is None:
             return Packet.guess_payload_class(self, payload)
+        return cls
 
 
-class BT_ACL_Hdr(Packet):
+class BT_ACL_Hdr(_FixedLayoutPacket):
     name = "BT ACL Header"
     fields_desc = [
         # BitField("rfu", 0, 3),
@@ -1867,7 +2061,14 @@ class BT_ACL_Hdr(Packet):
     ]
 
 
-class HCI_Command_Hdr(Packet):
+# Payload classes of BT_Baseband, by packet type
+_bt_baseband_payload_classes = {
+    0x04: BT_ACL_Hdr,  # DH1/2-DH1
+    0x08: BT_ACL_Hdr,  # DV/3-DH1
+}
+
+
+class HCI_Command_Hdr(_MemoizedPayloadPacket):
     name = "HCI Command header"
     fields_desc = [XLEShortField("opcode", 0),
                    LenField("len", None, fmt="B"), ]
@@ -1876,10 +2077,9 @@ class HCI_Command_Hdr(Packet):
         return False
 
     def post_build(self, p, pay):
-        p += pay
         if self.len is None:
-            p = p[:2] + struct.pack("B", len(pay)) + p[3:]
-        return p
+            p = p[:2] + _byte.pack(len(pay)) + p[3:]
+        return p + pay
 
 
 class HCI_Cmd_Reset(Packet):
@@ -1919,8 +2119,11 @@ class HCI_Cmd_Write_Local_Name(Packet):
 class HCI_Cmd_Write_Extended_Inquiry_Response(Packet):
     name = "Write Extended Inquiry Response"
     fields_desc = [ByteField("fec_required", 0),
-                   PacketListField("eir_data", [], EIR_Hdr,
-                                   length_from=lambda pkt: pkt.len)]
+                   EIRPacketListField("eir_data", [], EIR_Hdr)]
+
+    def extract_padding(self, s):
+        # Zeros after the significant part
+        return b"", s
 
 
 class HCI_Cmd_LE_Set_Scan_Parameters(Packet):
@@ -1944,7 +2147,7 @@ class HCI_Cmd_Disconnect(Packet):
                    ByteField("reason", 0x13), ]
 
 
-class HCI_Cmd_LE_Create_Connection(Packet):
+class HCI_Cmd_LE_Create_Connection(_FixedLayoutPacket):
     name = "LE Create Connection"
     fields_desc = [LEShortField("interval", 96),
                    LEShortField("window", 48),
@@ -1982,7 +2185,7 @@ class HCI_Cmd_LE_Remove_Device_From_White_List(HCI_Cmd_LE_Add_Device_To_White_Li
     name = "LE Remove Device from White List"
 
 
-class HCI_Cmd_LE_Connection_Update(Packet):
+class HCI_Cmd_LE_Connection_Update(_FixedLayoutPacket):
     name = "LE Connection Update"
     fields_desc = [XLEShortField("handle", 0),
                    XLEShortField("min_interval", 0),
@@ -2007,7 +2210,7 @@ class HCI_Cmd_LE_Set_Random_Address(Packet):
     fields_desc = [LEMACField("address", None)]
 
 
-class HCI_Cmd_LE_Set_Advertising_Parameters(Packet):
+class HCI_Cmd_LE_Set_Advertising_Parameters(_FixedLayoutPacket):
     name = "LE Set Advertising Parameters"
     fields_desc = [LEShortField("interval_min", 0x0800),
                    LEShortField("interval_max", 0x0800),
@@ -2031,6 +2234,16 @@ class HCI_Cmd_LE_Set_Advertising_Data(Packet):
                                        length_from=lambda pkt: pkt.len),
                        align=31, padwith=b"\0"), ]
 
+    def self_build(self, field_pos_list=None):
+        # The length field would build every EIR element to count its
+        # bytes, before the list builds them again: build them once
+        data = self.data
+        if self.raw_packet_cache is not None or self.len is not None or \
+                field_pos_list is not None or not isinstance(data, list):
+            return Packet.self_build(self, field_pos_list)
+        data = b"".join(raw(p) for p in data)
+        return _byte.pack(len(data)) + data + b"\0" * (-len(data) % 31)
+
 
 class HCI_Cmd_LE_Set_Scan_Response_Data(Packet):
     name = "LE Set Scan Response Data"
@@ -2062,7 +2275,7 @@ class HCI_Cmd_LE_Long_Term_Key_Request_Reply(Packet):
                    StrFixedLenField("ltk", b'\x00' * 16, 16), ]
 
 
-class HCI_Event_Hdr(Packet):
+class HCI_Event_Hdr(_MemoizedPayloadPacket):
     name = "HCI Event header"
     fields_desc = [XByteField("code", 0),
                    LenField("len", None, fmt="B"), ]
@@ -2096,10 +2309,11 @@ class HCI_Event_Command_Complete(Packet):
                    ByteEnumField("status", 0, _bluetooth_error_codes)]
 
     def answers(self, other):
-        if HCI_Command_Hdr not in other:
+        cmd = _get_layer(other, HCI_Command_Hdr)
+        if cmd is None:
             return False
 
-        return other[HCI_Command_Hdr].opcode == self.opcode
+        return cmd.opcode == self.opcode
 
 
 class HCI_Cmd_Complete_Read_BD_Addr(Packet):
@@ -2120,10 +2334,11 @@ class HCI_Event_Command_Status(Packet):
                    XLEShortField("opcode", None), ]
 
     def answers(self, other):
-        if HCI_Command_Hdr not in other:
+        cmd = _get_layer(other, HCI_Command_Hdr)
+        if cmd is None:
             return False
 
-        return other[HCI_Command_Hdr].opcode == self.opcode
+        return cmd.opcode == self.opcode
 
 
 class HCI_Event_Number_Of_Completed_Packets(Packet):
@@ -2131,7 +2346,7 @@ class HCI_Event_Number_Of_Completed_Packets(Packet):
     fields_desc = [ByteField("number", 0)]
 
 
-class HCI_Event_LE_Meta(Packet):
+class HCI_Event_LE_Meta(_MemoizedPayloadPacket):
     name = "LE Meta"
     fields_desc = [ByteEnumField("event", 0, {
         1: "connection_complete",
@@ -2148,7 +2363,7 @@ class HCI_Event_LE_Meta(Packet):
         return self.payload.answers(other)
 
 
-class HCI_LE_Meta_Connection_Complete(Packet):
+class HCI_LE_Meta_Connection_Complete(_FixedLayoutPacket):
     name = "Connection Complete"
     fields_desc = [ByteEnumField("status", 0, {0: "success"}),
                    LEShortField("handle", 0),
@@ -2161,14 +2376,14 @@ class HCI_LE_Meta_Connection_Complete(Packet):
                    XByteField("clock_latency", 5), ]
 
     def answers(self, other):
-        if HCI_Cmd_LE_Create_Connection not in other:
+        cmd = _get_layer(other, HCI_Cmd_LE_Create_Connection)
+        if cmd is None:
             return False
 
-        return (other[HCI_Cmd_LE_Create_Connection].patype == self.patype and
-                other[HCI_Cmd_LE_Create_Connection].paddr == self.paddr)
+        return cmd.patype == self.patype and cmd.paddr == self.paddr
 
 
-class HCI_LE_Meta_Connection_Update_Complete(Packet):
+class HCI_LE_Meta_Connection_Update_Complete(_FixedLayoutPacket):
     name = "Connection Update Complete"
     fields_desc = [ByteEnumField("status", 0, {0: "success"}),
                    LEShortField("handle", 0),
@@ -2177,26 +2392,26 @@ class HCI_LE_Meta_Connection_Update_Complete(Packet):
                    LEShortField("timeout", 42), ]
 
 
-class HCI_LE_Meta_Advertising_Report(Packet):
+class HCI_LE_Meta_Advertising_Report(_SnapshotPacket):
     name = "Advertising Report"
     fields_desc = [ByteEnumField("type", 0, {0: "conn_und", 4: "scan_rsp"}),
                    ByteEnumField("atype", 0, {0: "public", 1: "random"}),
                    LEMACField("addr", None),
                    FieldLenField("len", None, length_of="data", fmt="B"),
-                   PacketListField("data", [], EIR_Hdr,
-                                   length_from=lambda pkt: pkt.len),
+                   SnapshotPacketListField("data", [], EIR_Hdr,
+                                           length_from=lambda pkt: pkt.len),
                    SignedByteField("rssi", 0)]
 
     def extract_padding(self, s):
         return '', s
 
 
-class HCI_LE_Meta_Advertising_Reports(Packet):
+class HCI_LE_Meta_Advertising_Reports(_SnapshotPacket):
     name = "Advertising Reports"
     fields_desc = [FieldLenField("len", None, count_of="reports", fmt="B"),
-                   PacketListField("reports", None,
-                                   HCI_LE_Meta_Advertising_Report,
-                                   count_from=lambda pkt: pkt.len)]
+                   SnapshotPacketListField("reports", None,
+                                           HCI_LE_Meta_Advertising_Report,
+                                           count_from=lambda pkt: pkt.len)]
 
 
 class HCI_LE_Meta_Long_Term_Key_Request(Packet):
@@ -2452,9 +2667,12 @@ class LowEnergyBeaconHelper:
         :rtype: scapy.bluetooth.HCI_Hdr
         """
 
-        return HCI_Hdr() / HCI_Command_Hdr() / HCI_Cmd_LE_Set_Advertising_Data(
+        # The command is not copied, unlike with "/"
+        pkt = HCI_Hdr() / HCI_Command_Hdr()
+        pkt.add_payload(HCI_Cmd_LE_Set_Advertising_Data(
             data=self.build_eir()
-        )
+        ))
+        return pkt
 
 
 ###########
@@ -2495,6 +2713,10 @@ class BluetoothRFCommSocket(BluetoothL2CAPSocket):
         self.ins = self.outs = s
 
 
+# Timestamp ancillary data of the HCI sockets, see bluez/lib/hci.h
+HCI_CMSG_TSTAMP = 0x0002
+
+
 class BluetoothHCISocket(SuperSocket):
     desc = "read/write on a BlueTooth HCI socket"
 
@@ -2513,7 +2735,23 @@ class BluetoothHCISocket(SuperSocket):
     #        s.connect((peer,0))
 
     def recv(self, x=MTU):
-        return HCI_Hdr(self.ins.recv(x))
+        if six.PY2:
+            return HCI_Hdr(self.ins.recv(x))
+        # HCI_TIME_STAMP is set: use the time the kernel received the packet
+        # at rather than the time it is dissected at
+        data, ancdata, _, _ = self.ins.recvmsg(x, socket.CMSG_LEN(64))
+        pkt = HCI_Hdr(data)
+        for cmsg_lvl, cmsg_type, cmsg_data in ancdata:
+            if cmsg_lvl == socket.SOL_HCI and cmsg_type == HCI_CMSG_TSTAMP:
+                length = len(cmsg_data)
+                if length == 16:  # timeval
+                    tmp = struct.unpack("ll", cmsg_data)
+                elif length == 8:  # compat timeval
+                    tmp = struct.unpack("ii", cmsg_data)
+                else:
+                    continue
+                pkt.time = tmp[0] + tmp[1] * 1e-6
+        return pkt
 
 
 class sockaddr_hci(ctypes.Structure):
@@ -2524,6 +2762,27 @@ class sockaddr_hci(ctypes.Structure):
     ]
 
 
+# libc, loaded by _get_libc() when the first user channel socket is opened
+_libc = None
+
+
+def _get_libc():
+    """Returns libc, with the prototypes of socket(), bind() and close()"""
+    global _libc
+    if _libc is None:
+        libc = ctypes.CDLL("libc.so.6")
+        libc.socket.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int)
+        libc.socket.restype = ctypes.c_int
+        libc.bind.argtypes = (ctypes.c_int,
+                              ctypes.POINTER(sockaddr_hci),
+                              ctypes.c_int)
+        libc.bind.restype = ctypes.c_int
+        libc.close.argtypes = (ctypes.c_int,)
+        libc.close.restype = ctypes.c_int
+        _libc = libc
+    return _libc
+
+
 class BluetoothUserSocket(SuperSocket):
     desc = "read/write H4 over a Bluetooth user channel"
 
@@ -2539,18 +2798,9 @@ class BluetoothUserSocket(SuperSocket):
         # to call down into libc with ctypes
 
         sockaddr_hcip = ctypes.POINTER(sockaddr_hci)
-        ctypes.cdll.LoadLibrary("libc.so.6")
-        libc = ctypes.CDLL("libc.so.6")
-
+        libc = _get_libc()
         socket_c = libc.socket
-        socket_c.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_int)
-        socket_c.restype = ctypes.c_int
-
         bind = libc.bind
-        bind.argtypes = (ctypes.c_int,
-                         ctypes.POINTER(sockaddr_hci),
-                         ctypes.c_int)
-        bind.restype = ctypes.c_int
 
         ########
         # actual code
@@ -2575,9 +2825,11 @@ class BluetoothUserSocket(SuperSocket):
         self.send(cmd)
         while True:
             r = self.recv()
-            if r.type == 0x04 and r.code == 0xe and r.opcode == opcode:
-                if r.status != 0:
-                    raise BluetoothCommandError("Command %x failed with %x" % (opcode, r.status))  # noqa: E501
+            # Looking the fields up on r would search every layer for them
+            evt = _get_layer(r, HCI_Event_Command_Complete)
+            if evt is not None and evt.opcode == opcode:
+                if evt.status != 0:
+                    raise BluetoothCommandError("Command %x failed with %x" % (opcode, evt.status))  # noqa: E501
                 return r
 
     def recv(self, x=MTU):
@@ -2588,19 +2840,16 @@ class BluetoothUserSocket(SuperSocket):
         return len(ins) > 0
 
     def flush(self):
+        # The pending packets are dropped: no need to dissect them
         while self.readable():
-            self.recv()
+            self.ins.recv(MTU)
 
     def close(self):
         if self.closed:
             return
 
         # Properly close socket so we can free the device
-        ctypes.cdll.LoadLibrary("libc.so.6")
-        libc = ctypes.CDLL("libc.so.6")
-
-        close = libc.close
-        close.restype = ctypes.c_int
+        close = _get_libc().close
         self.closed = True
         if hasattr(self, "outs"):
             if not hasattr(self, "ins") or self.ins != self.outs: